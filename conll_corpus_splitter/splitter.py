@@ -1,15 +1,66 @@
+import logging
 import math
 import os
+import queue
 import random
 import re
+import threading
 
-from collections import OrderedDict
+from array import array
 from contextlib import ExitStack
 
-from .utils import Dataset, RotatingList, MetadataValue, MetadataDiffDict
+from .utils import Dataset, MetadataValue, MetadataDiffDict
 
 
 COMMENT_PATTERN = r'^#\s?(?P<attr_name>[^=]+?)(?:\s?=\s?(?P<attr_value>.+))?$'
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+logger = logging.getLogger(__name__)
+
+
+class _OutputWriter(object):
+    """
+    Feeds one output file from a dedicated thread, so writing overlaps with
+    parsing in the main thread. Payloads from a single writer are written in
+    order; errors raised in the thread resurface in write() or close().
+    """
+    def __init__(self, file, maxsize=1024):
+        self._file = file
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            payload = self._queue.get()
+            if payload is None:
+                return
+            # keep draining after an error so the producer never blocks on a
+            # full queue
+            if self._error is None:
+                try:
+                    self._file.write(payload)
+                except Exception as e:
+                    self._error = e
+
+    def write(self, payload):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(payload)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+def _advise_sequential(file):
+    # tell the kernel the file will be read front to back so it can batch
+    # readahead; not available on all platforms
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
 
 
 class CONLLCorpusIterator(object):
@@ -50,6 +101,27 @@ class CONLLCorpusIterator(object):
         self.sample_end_pattern = sample_end_pattern
         self.ignore_metadata_attributes = ignore_metadata_attributes
         self.append_newline = append_newline
+        self._start_re = re.compile(sample_start_pattern)
+        self._end_re = re.compile(sample_end_pattern)
+        self._comment_re = re.compile(comment_pattern)
+        # counting scans whole files in one go, so the pattern needs the
+        # per-line anchoring that re.match provided implicitly
+        if not sample_start_pattern.startswith('^'):
+            sample_start_pattern = r'^(?:{})'.format(sample_start_pattern)
+        self._start_scan_re = re.compile(sample_start_pattern, re.MULTILINE)
+        self._ignore_set = set(ignore_metadata_attributes)
+        self._blank_line_delimited = sample_end_pattern == r'\n'
+        if self._blank_line_delimited:
+            # the default end pattern just detects a blank line, which a plain
+            # string comparison does without invoking the regex engine
+            self._is_sample_end = '\n'.__eq__
+        else:
+            self._is_sample_end = self._end_re.match
+        if comment_pattern == COMMENT_PATTERN:
+            # the default comment format is plain enough for string ops
+            self._parse_comment = self._parse_comment_fast
+        else:
+            self._parse_comment = self._parse_comment_re
         self._sample_count = None
 
     def __iter__(self):
@@ -61,53 +133,165 @@ class CONLLCorpusIterator(object):
         (str, dict)
             Returns 2-tuple of sample text and related metadata.
         """
+        if self._blank_line_delimited:
+            return self._iter_blocks()
+        return self._iter_lines()
+
+    def _parse_comment_fast(self, line, line_no):
+        """
+        Parses a default-format comment line with string operations; returns
+        an (attr_name, MetadataValue) pair, or None for lines that are not
+        comments or whose attribute should be ignored.
+        """
+        if not line.startswith('#'):
+            return None
+        body = line[1:].lstrip().rstrip('\n')
+        if '=' in body:
+            attr_name, _, attr_value = body.partition('=')
+            if not attr_value:
+                # nothing at all after '=' (not even whitespace); the comment
+                # pattern requires a value once '=' is present
+                return None
+            attr_name = attr_name.strip()
+            attr_value = attr_value.strip()
+        else:
+            attr_name, attr_value = body.strip(), None
+        if not attr_name or attr_name in self._ignore_set:
+            return None
+        return attr_name, MetadataValue(value=attr_value, text=line.rstrip('\n'), line_no=line_no)
+
+    def _parse_comment_re(self, line, line_no):
+        """
+        Parses a comment line against the configured comment pattern; same
+        contract as _parse_comment_fast.
+        """
+        m = self._comment_re.match(line)
+        if not m:
+            return None
+        groups = m.groupdict()
+        if groups['attr_name'] in self._ignore_set:
+            return None
+        return groups['attr_name'], MetadataValue(
+            value=groups['attr_value'],
+            text=m.string[m.start():m.end()],
+            line_no=line_no
+        )
+
+    def _iter_blocks(self):
+        """
+        Iterates block-wise: each file is read in one gulp and split on blank
+        lines at C level, so only the few header lines of every sample are
+        dispatched on in Python.
+        """
+        sample_suffix = '\n\n' if self.append_newline else '\n'
+        # bind the per-line callables to locals; attribute lookups add up in
+        # this loop
+        start_match = self._start_re.match
+        parse_comment = self._parse_comment
+        new_metadata = MetadataDiffDict
+        line_index = 0
+        sample_count = 0
+        for filename in self.filenames:
+            with open(filename, 'r') as file:
+                _advise_sequential(file)
+                text = file.read()
+            metadata = new_metadata()
+            blocks = text.split('\n\n')
+            last_block = len(blocks) - 1
+            for block_no, block in enumerate(blocks):
+                # a block is only a complete sample if a blank line followed it
+                terminated = block_no < last_block
+                length = len(block)
+                offset = 0
+                block_line = line_index
+                while offset < length and block[offset] == '\n':
+                    # blank lines left over from consecutive separators
+                    offset += 1
+                    block_line += 1
+                while offset < length:
+                    end = block.find('\n', offset)
+                    if end == -1:
+                        line = block[offset:] + ('\n' if terminated else '')
+                        next_offset = length
+                    else:
+                        line = block[offset:end + 1]
+                        next_offset = end + 1
+                    if start_match(line):
+                        # the rest of the block is the sample body
+                        if terminated:
+                            yield block[offset:] + sample_suffix, metadata
+                            sample_count += 1
+                            metadata = new_metadata()
+                        break
+                    entry = parse_comment(line, block_line)
+                    if entry is not None:
+                        metadata[entry[0]] = entry[1]
+                    offset = next_offset
+                    block_line += 1
+                # advance the global line counter over the block and the blank
+                # separator that followed it; for an empty block both separator
+                # newlines are blank lines of their own
+                if terminated:
+                    line_index += (block.count('\n') + 1 if block else 1) + 1
+                elif block:
+                    line_index += block.count('\n') + (0 if block.endswith('\n') else 1)
+        self._sample_count = sample_count
+
+    def _iter_lines(self):
+        """
+        Iterates line-wise with a small state machine; kept as the generic
+        path for custom sample end patterns.
+        """
         with ExitStack() as stack:
             files = [stack.enter_context(open(filename, 'r')) for filename in self.filenames]
+            is_sample_end = self._is_sample_end
+            start_match = self._start_re.match
+            parse_comment = self._parse_comment
+            new_metadata = MetadataDiffDict
             line_index = -1
+            sample_count = 0
             for file in files:
-                text_buffer = ''
-                metadata = MetadataDiffDict()
+                _advise_sequential(file)
+                text_buffer = []
+                metadata = new_metadata()
                 reading_sample = False
                 for line in file:
                     line_index += 1
-                    if re.match(self.sample_end_pattern, line) and reading_sample:
+                    if is_sample_end(line) and reading_sample:
                         # end of sample
                         if self.append_newline:
-                            text_buffer += '\n'
-                        yield text_buffer, metadata.copy()
+                            text_buffer.append('\n')
+                        # the dict is handed over as-is; a fresh one is bound
+                        # below, so the consumer owns the yielded instance
+                        yield ''.join(text_buffer), metadata
+                        sample_count += 1
                         reading_sample = False
-                        text_buffer = ''
-                        metadata = MetadataDiffDict()
+                        text_buffer = []
+                        metadata = new_metadata()
                     elif reading_sample:
-                        text_buffer += line
+                        text_buffer.append(line)
                     else:
-                        if re.match(self.sample_start_pattern, line):
+                        if start_match(line):
                             # start of sample
                             reading_sample = True
-                            text_buffer += line
+                            text_buffer.append(line)
                             continue
 
-                        m = re.match(self.comment_pattern, line)
-                        if m:
-                            groups = m.groupdict()
-                            if groups['attr_name'] not in self.ignore_metadata_attributes:
-                                metadata[groups['attr_name']] = MetadataValue(
-                                    value=groups['attr_value'],
-                                    text=m.string[m.start():m.end()],
-                                    line_no=line_index
-                                )
+                        entry = parse_comment(line, line_index)
+                        if entry is not None:
+                            metadata[entry[0]] = entry[1]
+            # a full iteration has seen every sample, so the count comes for free
+            self._sample_count = sample_count
 
     def _count_samples(self):
         print('Counting samples...')
-        with ExitStack() as stack:
-            files = [stack.enter_context(open(filename, 'r')) for filename in self.filenames]
-            sample_count = 0
-            for file in files:
-                for line in file:
-                    if re.match(self.sample_start_pattern, line):
-                        sample_count += 1
-            self._sample_count = sample_count
-            print('%d samples read.' % sample_count)
+        sample_count = 0
+        for filename in self.filenames:
+            with open(filename, 'r') as file:
+                _advise_sequential(file)
+                sample_count += len(self._start_scan_re.findall(file.read()))
+        self._sample_count = sample_count
+        print('%d samples read.' % sample_count)
 
     @property
     def sample_count(self):
@@ -185,53 +369,55 @@ def split_corpus(source, output_folder, test=0.3, dev=0.0, seed=None, cross_vali
 
     cci = iterator_cls(*in_files)
 
+    # a single streaming pass collects the samples and yields the count as a
+    # side effect, instead of reading every input file twice
+    samples = list(cci)
+    sample_count = len(samples)
+
     if seed:
         random.seed(seed)
     else:
-        random.seed(cci.sample_count)
+        random.seed(sample_count)
 
-    dev_sample_count = math.floor(cci.sample_count * dev)
-    test_sample_count = math.floor(cci.sample_count * test)
-    train_sample_count = cci.sample_count - (dev_sample_count + test_sample_count)
+    dev_sample_count = math.floor(sample_count * dev)
+    test_sample_count = math.floor(sample_count * test)
 
     k = 1
     if cross_validation:
         k = math.floor(1 / test)
 
-    sample_indexes = RotatingList(range(cci.sample_count))
+    # a machine-typed array keeps the permutation at 8 bytes per index instead
+    # of a list of int objects; random.shuffle performs the same swaps on it,
+    # so the resulting split is unchanged
+    sample_indexes = array('q', range(sample_count))
     random.shuffle(sample_indexes)
 
     datafolds = []
     for fold in range(k):
-        datafold = {}
+        # sample indexes are exactly 0..sample_count-1, so a preallocated list
+        # indexed directly is already in sample order
+        datafold = [Dataset.TRAIN] * sample_count
         test_start_index = fold * test_sample_count
         test_end_index = test_start_index + test_sample_count
         dev_start_index = test_start_index - dev_sample_count
         dev_end_index = test_start_index
-        train_start_index = test_end_index
-        train_end_index = train_start_index + train_sample_count
 
-        test_samples = sorted(sample_indexes[test_start_index:test_end_index])
-        dev_samples = sorted(sample_indexes[dev_start_index:dev_end_index])
-        train_samples = sorted(sample_indexes[train_start_index:train_end_index])
-
-        for sample_index in sample_indexes:
-            if sample_index in test_samples:
-                datafold[sample_index] = Dataset.TEST
-            elif sample_index in train_samples:
-                datafold[sample_index] = Dataset.TRAIN
-            elif sample_index in dev_samples:
-                datafold[sample_index] = Dataset.DEV
+        # the test, dev and train slices partition the permutation, so every
+        # index outside the test and dev slices belongs to the train set and
+        # no per-sample membership tests are needed
+        for sample_index in sample_indexes[test_start_index:test_end_index]:
+            datafold[sample_index] = Dataset.TEST
+        if dev_start_index < 0:
+            # the dev slice precedes the test slice and wraps around the end
+            # of the shuffled index list on the first folds
+            dev_slice = sample_indexes[dev_start_index:] + sample_indexes[:dev_end_index]
+        else:
+            dev_slice = sample_indexes[dev_start_index:dev_end_index]
+        for sample_index in dev_slice:
+            datafold[sample_index] = Dataset.DEV
 
         datafolds.append(datafold)
 
-    for fold in range(len(datafolds)):
-        datafolds[fold] = OrderedDict(sorted(datafolds[fold].items(), key=lambda x: x[0])).values()
-
-    sample_index_relay = []
-    for fold_destinations in zip(*datafolds):
-        sample_index_relay.append(fold_destinations)
-
     with ExitStack() as stack:
         out_files = []
 
@@ -245,14 +431,16 @@ def split_corpus(source, output_folder, test=0.3, dev=0.0, seed=None, cross_vali
             out_files_fold = []
             out_files_fold.append(
                 stack.enter_context(
-                    open(os.path.join(output_folder, folder, output_filename.format('_train')), 'w')
+                    open(os.path.join(output_folder, folder, output_filename.format('_train')), 'wb',
+                         buffering=OUTPUT_BUFFER_SIZE)
                 )
             )
 
             if dev_sample_count:
                 out_files_fold.append(
                     stack.enter_context(
-                        open(os.path.join(output_folder, folder, output_filename.format('_dev')), 'w')
+                        open(os.path.join(output_folder, folder, output_filename.format('_dev')), 'wb',
+                             buffering=OUTPUT_BUFFER_SIZE)
                     )
                 )
             else:
@@ -260,24 +448,57 @@ def split_corpus(source, output_folder, test=0.3, dev=0.0, seed=None, cross_vali
 
             out_files_fold.append(
                 stack.enter_context(
-                    open(os.path.join(output_folder, folder, output_filename.format('_test')), 'w')
+                    open(os.path.join(output_folder, folder, output_filename.format('_test')), 'wb',
+                         buffering=OUTPUT_BUFFER_SIZE)
                 )
             )
 
             out_files.append(out_files_fold)
 
         global_meta = MetadataDiffDict()
-        fold_meta = [[MetadataDiffDict() for _ in (Dataset.TRAIN, Dataset.DEV, Dataset.TEST)] for _ in range(k)]
-        for sample_index, (sample, meta) in enumerate(cci):
-            global_meta.update(meta)
-            for fold, destination in enumerate(sample_index_relay[sample_index]):
-                diff = fold_meta[fold][destination].diff_and_update(global_meta)
-                print('Sample index: {}, k={} --> {}'.format(sample_index, fold, repr(destination)))
-
-                if not omit_metadata:
-                    for _, v in diff.items():
-                        out_files[fold][destination].write('{}\n'.format(v.text))
-
-                out_files[fold][destination].write(sample)
+        # each destination only needs to remember which version of the global
+        # metadata it has already written, not a full copy of it
+        fold_versions = [[0 for _ in (Dataset.TRAIN, Dataset.DEV, Dataset.TEST)] for _ in range(k)]
+
+        def write_sample(fold, destination, data):
+            if omit_metadata:
+                writers[fold][destination].write(data)
+                return
+            diff_items = global_meta.items_since(fold_versions[fold][destination])
+            fold_versions[fold][destination] = global_meta.version
+            if diff_items:
+                header = ''.join('{}\n'.format(v.text) for _, v in diff_items)
+                writers[fold][destination].write(header.encode('utf-8') + data)
+            else:
+                writers[fold][destination].write(data)
+
+        # one writer thread per output file keeps that file's payloads in
+        # order while the main thread goes on parsing the next sample
+        writers = [
+            [_OutputWriter(file) if file is not None else None for file in fold_files]
+            for fold_files in out_files
+        ]
+        try:
+            if k == 1:
+                # the common single-split case needs no per-fold relay at all
+                datafold = datafolds[0]
+                for sample_index, (sample, meta) in enumerate(samples):
+                    global_meta.update(meta)
+                    logger.debug('Sample index: %d, k=%d --> %r', sample_index, 0, datafold[sample_index])
+                    write_sample(0, datafold[sample_index], sample.encode('utf-8'))
+            else:
+                sample_index_relay = list(zip(*datafolds))
+                for sample_index, (sample, meta) in enumerate(samples):
+                    global_meta.update(meta)
+                    # encode once; the same bytes go to every fold
+                    data = sample.encode('utf-8')
+                    for fold, destination in enumerate(sample_index_relay[sample_index]):
+                        logger.debug('Sample index: %d, k=%d --> %r', sample_index, fold, destination)
+                        write_sample(fold, destination, data)
+        finally:
+            for fold_writers in writers:
+                for writer in fold_writers:
+                    if writer is not None:
+                        writer.close()
 
     print('Done.')
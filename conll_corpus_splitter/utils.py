@@ -12,7 +12,31 @@ class Dataset(IntEnum):
         return self.name
 
 
+def _invalidates_double(method):
+    def wrapper(self, *args, **kwargs):
+        self._doubled = None
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
 class RotatingList(list):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._doubled = None
+
+    __setitem__ = _invalidates_double(list.__setitem__)
+    __delitem__ = _invalidates_double(list.__delitem__)
+    __iadd__ = _invalidates_double(list.__iadd__)
+    __imul__ = _invalidates_double(list.__imul__)
+    append = _invalidates_double(list.append)
+    extend = _invalidates_double(list.extend)
+    insert = _invalidates_double(list.insert)
+    pop = _invalidates_double(list.pop)
+    remove = _invalidates_double(list.remove)
+    clear = _invalidates_double(list.clear)
+    sort = _invalidates_double(list.sort)
+    reverse = _invalidates_double(list.reverse)
+
     def __getitem__(self, index):
         if isinstance(index, int):
             index %= len(self)
@@ -39,6 +63,13 @@ class RotatingList(list):
             stop %= len(self)
 
             if step > 0 and stop < start:
+                if step == 1:
+                    # wrapping slices of unit step come straight out of a
+                    # cached doubled copy instead of concatenating two fresh
+                    # lists on every access
+                    if self._doubled is None:
+                        self._doubled = list.__add__(self, self)
+                    return self._doubled[start:stop + len(self)]
                 return super().__getitem__(slice(start, len(self), step)) + super().__getitem__(slice(0, stop, step))
 
             elif step < 0 and stop > start:
@@ -55,8 +86,26 @@ class MetadataValue(namedtuple('MetadataValue', ['value', 'text', 'line_no'])):
 
 
 class MetadataDiffDict(OrderedDict):
-    def diff_and_update(self, updating_dict):
-        diff_items = sorted(set(updating_dict.items()) - set(self.items()), key=lambda v: v[1].line_no)
-        diff = self.__class__(diff_items)
-        self.update(updating_dict)
-        return diff
+    def __init__(self, *args, **kwargs):
+        self._version = 0
+        self._versions = {}
+        super().__init__(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._version += 1
+        self._versions[key] = self._version
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        del self._versions[key]
+
+    @property
+    def version(self):
+        return self._version
+
+    def items_since(self, version):
+        if version >= self._version:
+            return []
+        changed = sorted((ver, key) for key, ver in self._versions.items() if ver > version)
+        return [(key, self[key]) for _, key in changed]